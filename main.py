@@ -1,58 +1,173 @@
 import os
-import glob
+import sys
+import json
+import asyncio
+import hashlib
+import sqlite3
+from operator import itemgetter
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import httpx
+import chromadb
+import numpy as np
+import semchunk
+from tqdm import tqdm
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import torch
+from langchain_openai import ChatOpenAI
+from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
-from langchain_community.document_loaders import TextLoader, PyPDFLoader
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.documents import Document
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough, RunnableParallel
+from langchain_core.runnables import RunnableBranch, RunnablePassthrough
+from langchain_core.runnables.history import RunnableWithMessageHistory
+from pdf_loader import MP_CONTEXT, load_pdf
 
 # Load environment variables
 load_dotenv()
 
-# Check if API key is available
-if not os.getenv("OPENAI_API_KEY"):
-    raise ValueError("OPENAI_API_KEY environment variable is not set")
+# Local sentence-transformers model used for all embeddings (384 dimensions)
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Vector store collection and its HNSW index parameters. Embeddings are
+# normalized, so inner product ranks exactly like cosine similarity.
+COLLECTION_NAME = "rag"
+COLLECTION_METADATA = {
+    "hnsw:space": "ip",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64
+}
+
+# Number of chunks embedded and written to the collection per indexing batch
+INDEX_BATCH_SIZE = 5000
+
+# The CLI holds a single conversation, so every chain call uses one history session
+SESSION_CONFIG = {"configurable": {"session_id": "default"}}
+
+# Maximum inner product distance at which a previous answer is reused for a new question
+QUERY_CACHE_MAX_DISTANCE = 0.05
 
 class RAGSystem:
-    def __init__(self, document_dir="./documents"):
+    def __init__(self, document_dir="./documents", reindex=False, embeddings=None, llm=None):
         self.document_dir = document_dir
-        self.embeddings = OpenAIEmbeddings()
-        self.llm = ChatOpenAI(model_name="gpt-3.5-turbo")
+        self.reindex = reindex
+        
+        # The embedding model must expose model_name, which keys the caches and index
+        if embeddings is None:
+            embeddings = HuggingFaceEmbeddings(
+                model_name=EMBEDDING_MODEL,
+                model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"},
+                encode_kwargs={"batch_size": 64, "normalize_embeddings": True}
+            )
+        self.embeddings = embeddings
+        
+        # Persistent cache of chunk embeddings, opened only when something needs embedding
+        self._emb_cache = None
+        
+        # HTTP clients owned by this instance, released by close()/aclose()
+        self._http_client = None
+        self._http_async_client = None
+        
+        if llm is None:
+            # Check if API key is available
+            if not os.getenv("OPENAI_API_KEY"):
+                raise ValueError("OPENAI_API_KEY environment variable is not set")
+            
+            # Reuse pooled HTTP/2 connections to the OpenAI API across LLM calls
+            limits = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+            self._http_client = httpx.Client(http2=True, limits=limits, timeout=60)
+            self._http_async_client = httpx.AsyncClient(http2=True, limits=limits, timeout=60)
+            llm = ChatOpenAI(
+                model_name="gpt-3.5-turbo",
+                http_client=self._http_client,
+                http_async_client=self._http_async_client
+            )
+        self.llm = llm
         
         # Use the new message history approach
         self.message_history = ChatMessageHistory()
         
         self.vectorstore = None
         self.rag_chain = None
+        self._qcache = None
         
         # Initialize the system
         self.initialize()
     
+    def close(self):
+        """Close the HTTP connection pool used by the synchronous query API.
+        
+        After using the async API, call aclose() from the same event loop instead.
+        """
+        if self._http_client is not None:
+            self._http_client.close()
+    
+    async def aclose(self):
+        """Close the HTTP connection pools of both the sync and async query APIs"""
+        self.close()
+        if self._http_async_client is not None:
+            await self._http_async_client.aclose()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+    
     def initialize(self):
-        """Initialize the RAG system by loading and indexing documents"""
-        # Load documents
-        documents = self.load_documents()
+        """Initialize the RAG system, indexing only new or changed documents"""
+        client = chromadb.PersistentClient(path="./chroma_db")
+        manifest = self._load_manifest()
+        collection_metadata = {**COLLECTION_METADATA, "embedding_model": self.embeddings.model_name}
+        
+        # Drop the existing index entirely when a full reindex is requested or
+        # it was built with a different embedding model
+        collection = client.get_or_create_collection(COLLECTION_NAME)
+        if self.reindex or (collection.metadata or {}).get("embedding_model") != self.embeddings.model_name:
+            client.delete_collection(COLLECTION_NAME)
+            collection = client.create_collection(COLLECTION_NAME, metadata=collection_metadata)
         
-        if not documents:
+        # A manifest without a populated collection describes nothing
+        if collection.count() == 0:
+            manifest = {}
+        
+        # Diff the documents directory against what has already been indexed
+        current = self._scan_document_files()
+        removed = [path for path in manifest if path not in current]
+        changed = {path: stat for path, stat in current.items()
+                   if path not in manifest
+                   or (manifest[path]["mtime"], manifest[path].get("size")) != stat}
+        
+        # Loading, splitting and embedding only happen when the documents changed
+        indexed = 0
+        if removed or changed:
+            indexed = self.build_index(collection, manifest, removed, changed)
+        
+        # Cached answers may be stale once the indexed documents change
+        if self.reindex or removed or changed:
+            client.get_or_create_collection("qcache")
+            client.delete_collection("qcache")
+        self._qcache = client.get_or_create_collection("qcache", metadata={"hnsw:space": "ip"})
+        
+        if collection.count() == 0:
             print("No documents found. Please add documents to the documents directory.")
             return
         
-        # Split documents into chunks
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=100
-        )
-        split_docs = text_splitter.split_documents(documents)
-        
-        # Create vector store
-        self.vectorstore = Chroma.from_documents(
-            documents=split_docs,
-            embedding=self.embeddings,
-            persist_directory="./chroma_db"
+        self.vectorstore = Chroma(
+            client=client,
+            collection_name=COLLECTION_NAME,
+            collection_metadata=collection_metadata,
+            embedding_function=self.embeddings
         )
         
         # Create retriever
@@ -69,88 +184,313 @@ Context: {context}
 """
 
         # Create the full RAG chain using the Model Context Protocol pattern
-        # 1. Create the context builder (retriever + formatter)
-        def format_docs(docs):
-            return "\n\n".join(doc.page_content for doc in docs)
-        
-        # 2. Define how to construct a prompt given the message history and context
-        def build_prompt(input_dict):
-            question = input_dict["question"]
-            context = input_dict["context"]
-            chat_history = input_dict["chat_history"]
-            
-            messages = [SystemMessage(content=system_template.format(context=context))]
-            
-            # Format chat history
-            for msg, res in chat_history:
-                messages.append(HumanMessage(content=msg))
-                messages.append(AIMessage(content=res))
-                
-            # Add the current question
-            messages.append(HumanMessage(content=question))
-            
-            return messages
+        # 1. Create the context builder (retriever + page content extractor)
+        def get_contents(docs):
+            return [doc.page_content for doc in docs]
         
-        # 3. Create the RAG chain
-        retriever_chain = RunnableParallel(
-            {"context": retriever | format_docs, 
-             "question": RunnablePassthrough(), 
-             "chat_history": lambda x: self._get_chat_history()}
-        )
+        # 2. Define the prompt from the system context, message history and question
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", system_template),
+            MessagesPlaceholder("history"),
+            ("human", "{question}")
+        ])
         
-        self.rag_chain = (
-            retriever_chain 
-            | build_prompt
+        # 3. Create the RAG chain, returning the retrieved context alongside the answer.
+        # When the caller already embedded the question (qvec) it is searched with
+        # directly instead of being embedded a second time by the retriever.
+        retrieve = RunnableBranch(
+            (lambda x: x.get("qvec") is not None,
+             lambda x: self.vectorstore.similarity_search_by_vector(x["qvec"], k=3)),
+            itemgetter("question") | retriever
+        )
+        chain = RunnablePassthrough.assign(
+            context=retrieve | get_contents
+        ) | RunnablePassthrough.assign(
+            answer=RunnablePassthrough.assign(context=lambda x: "\n\n".join(x["context"]))
+            | prompt
             | self.llm
             | StrOutputParser()
         )
         
-        print(f"Indexed {len(split_docs)} document chunks.")
+        # 4. Let LangChain read and record the message history around the chain
+        self.rag_chain = RunnableWithMessageHistory(
+            chain,
+            lambda session_id: self.message_history,
+            input_messages_key="question",
+            history_messages_key="history",
+            output_messages_key="answer"
+        )
+        
+        print(f"Indexed {indexed} document chunks ({collection.count()} total).")
+    
+    def load_and_split(self, file_paths):
+        """Load the given files and yield their chunks, one file at a time"""
+        chunker = semchunk.chunkerify(len, chunk_size=1000)
+        for documents in self._iter_documents(file_paths):
+            if not documents:
+                continue
+            chunked_texts = chunker([doc.page_content for doc in documents], overlap=100)
+            for doc, chunks in zip(documents, chunked_texts):
+                for chunk in chunks:
+                    yield Document(page_content=chunk, metadata=doc.metadata)
+    
+    def build_index(self, collection, manifest, removed, changed):
+        """Update the collection for removed files and changed files (path -> (mtime, size))"""
+        # Remove stale chunks for deleted and modified files
+        for path in removed + list(changed):
+            collection.delete(where={"source": path})
+            manifest.pop(path, None)
+        
+        for path, (mtime, size) in changed.items():
+            manifest[path] = {"mtime": mtime, "size": size, "ids": []}
+        
+        # Stream chunks through embedding and indexing one bounded batch at a time,
+        # so memory use depends on the batch size rather than the corpus size
+        chunks = self.load_and_split(list(changed))
+        indexed = 0
+        with tqdm(desc="Indexing", unit="chunk", leave=False) as progress:
+            for batch in iter(lambda: list(islice(chunks, INDEX_BATCH_SIZE)), []):
+                texts = [doc.page_content for doc in batch]
+                metadatas = [doc.metadata for doc in batch]
+                ids = []
+                for doc in batch:
+                    entry = manifest[doc.metadata["source"]]
+                    entry["ids"].append(f"{doc.metadata['source']}:{len(entry['ids'])}")
+                    ids.append(entry["ids"][-1])
+                
+                # Only cache misses are sent to the embedding model
+                vectors = self._embed_with_cache(texts)
+                collection.upsert(
+                    ids=ids,
+                    embeddings=vectors,
+                    documents=texts,
+                    metadatas=metadatas
+                )
+                indexed += len(batch)
+                progress.update(len(batch))
+        self._save_manifest(manifest)
+        
+        return indexed
     
-    def _get_chat_history(self):
-        """Extract chat history in the format (human_message, ai_message)"""
-        chat_history = []
-        messages = self.message_history.messages
+    def _get_emb_cache(self):
+        """Open the persistent cache of chunk embeddings keyed by content hash"""
+        if self._emb_cache is None:
+            self._emb_cache = sqlite3.connect("./emb_cache.db")
+            self._emb_cache.execute(
+                "CREATE TABLE IF NOT EXISTS emb (hash TEXT PRIMARY KEY, vec BLOB)"
+            )
+        return self._emb_cache
+    
+    def _embed_with_cache(self, texts):
+        """Embed texts, reusing cached vectors for chunks that were embedded before"""
+        emb_cache = self._get_emb_cache()
+        model = self.embeddings.model_name
+        hashes = [hashlib.sha256(f"{model}\0{text}".encode()).hexdigest() for text in texts]
+        
+        # Look up cached vectors (in slices to stay under SQLite's variable limit)
+        vectors = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        for i in range(0, len(unique_hashes), 500):
+            batch = unique_hashes[i:i + 500]
+            rows = emb_cache.execute(
+                f"SELECT hash, vec FROM emb WHERE hash IN ({','.join('?' * len(batch))})",
+                batch
+            )
+            for h, vec in rows:
+                vectors[h] = np.frombuffer(vec, dtype=np.float32)
         
-        # Process history if we have previous exchanges
-        for i in range(0, len(messages)-1, 2):
-            if i+1 < len(messages):
-                if isinstance(messages[i], HumanMessage) and isinstance(messages[i+1], AIMessage):
-                    chat_history.append((messages[i].content, messages[i+1].content))
+        # Embed and store the misses
+        misses = {h: text for h, text in zip(hashes, texts) if h not in vectors}
+        if misses:
+            # The local model batches internally via encode_kwargs["batch_size"]. Chroma
+            # needs every vector in a batch to be the same type, so fresh vectors are
+            # converted to match the float32 arrays read from the cache.
+            new_vectors = [
+                np.asarray(vec, dtype=np.float32)
+                for vec in self.embeddings.embed_documents(list(misses.values()))
+            ]
+            emb_cache.executemany(
+                "INSERT OR REPLACE INTO emb (hash, vec) VALUES (?, ?)",
+                [(h, vec.tobytes()) for h, vec in zip(misses, new_vectors)]
+            )
+            emb_cache.commit()
+            vectors.update(zip(misses, new_vectors))
         
-        return chat_history
+        print(f"Embedded {len(misses)} new chunks ({len(unique_hashes) - len(misses)} from cache).")
+        return [vectors[h] for h in hashes]
     
-    def load_documents(self):
-        """Load documents from the document directory"""
-        documents = []
+    def _load_manifest(self):
+        """Load the mapping of indexed file paths to their mtime, size and chunk ids"""
+        if not os.path.exists("./chroma_db/manifest.json"):
+            return {}
+        with open("./chroma_db/manifest.json") as f:
+            return json.load(f)
+    
+    def _save_manifest(self, manifest):
+        """Persist the index manifest next to the vector database"""
+        with open("./chroma_db/manifest.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+    
+    def _scan_document_files(self):
+        """Map each supported file in the document directory to its (mtime, size)"""
+        files = {}
+        if not os.path.isdir(self.document_dir):
+            return files
         
-        # Load text files
-        for file_path in glob.glob(os.path.join(self.document_dir, "*.txt")):
-            loader = TextLoader(file_path)
-            documents.extend(loader.load())
-            print(f"Loaded text document: {file_path}")
+        # A single directory sweep gives names, types and stats together
+        with os.scandir(self.document_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.rsplit(".", 1)[-1].lower() in ("txt", "pdf"):
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_mtime, stat.st_size)
+        return files
+    
+    def load_documents(self, file_paths=None):
+        """Load documents from the given files, or the whole document directory"""
+        if file_paths is None:
+            file_paths = list(self._scan_document_files())
         
-        # Load PDF files
-        for file_path in glob.glob(os.path.join(self.document_dir, "*.pdf")):
-            loader = PyPDFLoader(file_path)
-            documents.extend(loader.load())
-            print(f"Loaded PDF document: {file_path}")
+        return [doc for docs in self._iter_documents(file_paths) for doc in docs]
+    
+    def _iter_documents(self, file_paths):
+        """Yield the documents loaded from each file in turn"""
+        # Load text files
+        for file_path in file_paths:
+            if not file_path.lower().endswith(".pdf"):
+                with open(file_path, encoding="utf-8", errors="replace") as f:
+                    docs = [Document(page_content=f.read(), metadata={"source": file_path})]
+                print(f"Loaded text document: {file_path}")
+                yield docs
         
-        return documents
+        # Load PDF files, parsing several at once in worker processes as it is CPU-bound
+        pdf_paths = [file_path for file_path in file_paths if file_path.lower().endswith(".pdf")]
+        if len(pdf_paths) > 1:
+            workers = min(len(pdf_paths), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=MP_CONTEXT) as executor:
+                # Keep a bounded window of files in flight, submitting the next file as
+                # each one is handed over, so workers stay busy while earlier files are
+                # indexed without parsed files piling up in memory
+                remaining = iter(pdf_paths)
+                pending = deque(
+                    (file_path, executor.submit(load_pdf, file_path))
+                    for file_path in islice(remaining, 2 * workers)
+                )
+                while pending:
+                    file_path, future = pending.popleft()
+                    next_path = next(remaining, None)
+                    if next_path is not None:
+                        pending.append((next_path, executor.submit(load_pdf, next_path)))
+                    docs = future.result()
+                    print(f"Loaded PDF document: {file_path}")
+                    yield docs
+        else:
+            for file_path in pdf_paths:
+                docs = load_pdf(file_path)
+                print(f"Loaded PDF document: {file_path}")
+                yield docs
     
     def query(self, question):
         """Process a user query and return the response"""
+        return self.query_with_context(question)[0]
+    
+    def query_with_context(self, question):
+        """Process a user query and return the response with the retrieved contexts"""
         if not self.rag_chain:
             raise ValueError("RAG system is not initialized")
-            
-        # Invoke the chain with the question
-        response = self.rag_chain.invoke(question)
         
-        # Update message history
+        # Reuse the answer of a semantically equivalent earlier question if there is one.
+        # Answers depend on the conversation, so only a session's opening question is cached.
+        qvec = cached = None
+        if not self.message_history.messages:
+            qvec = self.embeddings.embed_query(question)
+            cached = self._get_cached_answer(qvec)
+        if cached:
+            response, contexts = cached
+            self._add_to_history(question, response)
+        else:
+            # Invoke the chain with the question; it updates the message history itself
+            result = self.rag_chain.invoke(
+                {"question": question, "qvec": qvec}, config=SESSION_CONFIG
+            )
+            response, contexts = result["answer"], result["context"]
+            if qvec is not None:
+                self._cache_answer(question, qvec, response, contexts)
+        
+        return response, contexts
+    
+    async def aquery(self, question):
+        """Asynchronous version of query, so several questions can run concurrently"""
+        return (await self.aquery_with_context(question))[0]
+    
+    async def aquery_with_context(self, question):
+        """Asynchronous version of query_with_context"""
+        if not self.rag_chain:
+            raise ValueError("RAG system is not initialized")
+        
+        qvec = cached = None
+        if not self.message_history.messages:
+            qvec = await self.embeddings.aembed_query(question)
+            cached = self._get_cached_answer(qvec)
+        if cached:
+            response, contexts = cached
+            self._add_to_history(question, response)
+        else:
+            result = await self.rag_chain.ainvoke(
+                {"question": question, "qvec": qvec}, config=SESSION_CONFIG
+            )
+            response, contexts = result["answer"], result["context"]
+            if qvec is not None:
+                self._cache_answer(question, qvec, response, contexts)
+        
+        return response, contexts
+    
+    async def astream_query(self, question):
+        """Process a user query, yielding the response in chunks as it is generated"""
+        if not self.rag_chain:
+            raise ValueError("RAG system is not initialized")
+        
+        qvec = cached = None
+        if not self.message_history.messages:
+            qvec = await self.embeddings.aembed_query(question)
+            cached = self._get_cached_answer(qvec)
+        if cached:
+            response = cached[0]
+            self._add_to_history(question, response)
+            yield response
+        else:
+            # The message history is updated by the chain once the stream completes
+            chunks, contexts = [], []
+            chain_input = {"question": question, "qvec": qvec}
+            async for chunk in self.rag_chain.astream(chain_input, config=SESSION_CONFIG):
+                if "context" in chunk:
+                    contexts = chunk["context"]
+                if "answer" in chunk:
+                    chunks.append(chunk["answer"])
+                    yield chunk["answer"]
+            if qvec is not None:
+                self._cache_answer(question, qvec, "".join(chunks), contexts)
+    
+    def _add_to_history(self, question, response):
+        """Record a question and its answer served outside the chain"""
         self.message_history.add_user_message(question)
         self.message_history.add_ai_message(response)
-        
-        return response
+    
+    def _get_cached_answer(self, qvec):
+        """Return the cached (answer, contexts) for a question embedding, or None on a miss"""
+        hits = self._qcache.query(query_embeddings=[qvec], n_results=1)
+        if hits["ids"][0] and hits["distances"][0][0] < QUERY_CACHE_MAX_DISTANCE:
+            metadata = hits["metadatas"][0][0]
+            return metadata["answer"], json.loads(metadata.get("contexts", "[]"))
+        return None
+    
+    def _cache_answer(self, question, qvec, response, contexts):
+        """Store an answer and its contexts in the semantic query cache"""
+        self._qcache.upsert(
+            ids=[hashlib.sha1(question.encode()).hexdigest()],
+            embeddings=[qvec],
+            documents=[question],
+            metadatas=[{"answer": response, "contexts": json.dumps(contexts)}]
+        )
 
 def main():
     # Initialize the RAG system
@@ -162,18 +502,25 @@ def main():
     
     print("\nRAG System initialized! Type 'exit' to quit.\n")
     
-    # Interactive query loop
-    while True:
-        question = input("\nEnter your question: ")
-        
-        if question.lower() == 'exit':
-            break
-        
-        try:
-            answer = rag_system.query(question)
-            print(f"\nAnswer: {answer}")
-        except Exception as e:
-            print(f"Error: {e}")
+    # Interactive query loop, run on a single event loop so answers can be streamed
+    async def query_loop():
+        async with rag_system:
+            while True:
+                question = input("\nEnter your question: ")
+                
+                if question.lower() == 'exit':
+                    break
+                
+                try:
+                    print("\nAnswer: ", end="", flush=True)
+                    async for token in rag_system.astream_query(question):
+                        sys.stdout.write(token)
+                        sys.stdout.flush()
+                    print()
+                except Exception as e:
+                    print(f"Error: {e}")
+    
+    asyncio.run(query_loop())
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
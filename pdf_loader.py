@@ -0,0 +1,19 @@
+# PDF parsing for worker processes, kept apart from main.py so the worker function
+# can be pickled by reference without depending on the RAG system itself.
+import multiprocessing
+from langchain_community.document_loaders import PyPDFLoader
+
+# Workers are never forked from the process that has loaded the embedding model
+# and used its tokenizer threads. They fork from a fork server, or are spawned on
+# Windows, which has no fork server. Both still import the entry script once as
+# __main__: the fork server preloads it a single time for all workers, while spawn
+# re-imports it in every worker. That is cheap for rag_cli.py, whose module level
+# only imports the standard library, but pulls in torch, Chroma and LangChain
+# when main.py is run directly.
+MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+def load_pdf(file_path):
+    """Parse a PDF file into documents"""
+    return PyPDFLoader(file_path).load()
@@ -2,8 +2,8 @@
 import os
 import sys
 import shutil
+import asyncio
 import argparse
-from main import RAGSystem
 
 def setup_argparse():
     parser = argparse.ArgumentParser(
@@ -25,6 +25,9 @@ Examples:
 
   # Remove a document from the system
   python rag_cli.py --remove document.txt
+
+  # Rebuild the whole index before running
+  python rag_cli.py --reindex
 """
     )
 
@@ -52,6 +55,12 @@ Examples:
         help="Clear the vector database (forces reindexing)"
     )
     
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        help="Rebuild the vector database from scratch before running"
+    )
+    
     return parser.parse_args()
 
 def add_documents(file_paths):
@@ -82,10 +91,7 @@ def add_documents(file_paths):
     
     if added_count > 0:
         print(f"Successfully added {added_count} document(s)")
-        # Clear the vector database to force reindexing
-        if os.path.exists("./chroma_db"):
-            shutil.rmtree("./chroma_db")
-            print("Cleared vector database for reindexing")
+        print("Changes will be indexed on next run")
 
 def list_documents():
     document_dir = "./documents"
@@ -110,12 +116,22 @@ def remove_documents(file_names):
         print("No documents directory found")
         return
     
+    # List the directory once and match every requested name against it
+    all_files = set(os.listdir(document_dir))
+    lower_index = {}
+    for f in sorted(all_files):
+        lower_index.setdefault(f.lower(), []).append(f)
+    
     removed_count = 0
     for file_name in file_names:
         file_path = os.path.join(document_dir, file_name)
-        if not os.path.exists(file_path):
-            # Check if the user provided a partial name
-            matching_files = [f for f in os.listdir(document_dir) if file_name in f]
+        if file_name not in all_files:
+            # Match case-insensitively, on the full name first and then on part of it
+            query = file_name.lower()
+            if query in lower_index:
+                matching_files = list(lower_index[query])
+            else:
+                matching_files = sorted(f for f in all_files if query in f.lower())
             if len(matching_files) == 1:
                 file_path = os.path.join(document_dir, matching_files[0])
                 file_name = matching_files[0]
@@ -132,15 +148,17 @@ def remove_documents(file_names):
             os.remove(file_path)
             print(f"Removed document: {file_name}")
             removed_count += 1
+            all_files.discard(file_name)
+            same_name = lower_index[file_name.lower()]
+            same_name.remove(file_name)
+            if not same_name:
+                del lower_index[file_name.lower()]
         except Exception as e:
             print(f"Error removing {file_name}: {e}")
     
     if removed_count > 0:
         print(f"Successfully removed {removed_count} document(s)")
-        # Clear the vector database to force reindexing
-        if os.path.exists("./chroma_db"):
-            shutil.rmtree("./chroma_db")
-            print("Cleared vector database for reindexing")
+        print("Changes will be indexed on next run")
 
 def clear_vector_db():
     if os.path.exists("./chroma_db"):
@@ -169,10 +187,13 @@ def main():
         clear_vector_db()
         return
     
-    # If no arguments are provided, run the RAG system
+    # If no arguments are provided, run the RAG system. It is imported here so the
+    # document management commands above never load the embedding model or index.
+    from main import RAGSystem
+    
     try:
         # Initialize the RAG system
-        rag_system = RAGSystem()
+        rag_system = RAGSystem(reindex=args.reindex)
         
         if not rag_system.rag_chain:
             print("Failed to initialize RAG system. Exiting.")
@@ -180,19 +201,26 @@ def main():
         
         print("\nRAG System initialized! Type 'exit' to quit.\n")
         
-        # Interactive query loop
-        while True:
-            question = input("\nEnter your question: ")
-            
-            if question.lower() == 'exit':
-                break
-            
-            try:
-                # Use the query method with the Model Context Protocol
-                response = rag_system.query(question)
-                print(f"\nAnswer: {response}")
-            except Exception as e:
-                print(f"Error: {e}")
+        # Interactive query loop, run on a single event loop so answers can be streamed
+        async def query_loop():
+            async with rag_system:
+                while True:
+                    question = input("\nEnter your question: ")
+                    
+                    if question.lower() == 'exit':
+                        break
+                    
+                    try:
+                        # Stream the answer as the LLM generates it
+                        print("\nAnswer: ", end="", flush=True)
+                        async for token in rag_system.astream_query(question):
+                            sys.stdout.write(token)
+                            sys.stdout.flush()
+                        print()
+                    except Exception as e:
+                        print(f"Error: {e}")
+        
+        asyncio.run(query_loop())
     
     except KeyboardInterrupt:
         print("\nExiting RAG system...")
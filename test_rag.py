@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 import os
 import sys
+import asyncio
+import tempfile
 import unittest
 from unittest.mock import patch
 from io import StringIO
-from main import RAGSystem
+import chromadb
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models import FakeListChatModel
+from main import RAGSystem, COLLECTION_NAME
+from rag_cli import remove_documents
+
+class FakeEmbeddings(DeterministicFakeEmbedding):
+    """Deterministic embeddings that need no model download or API key"""
+    model_name: str = "fake-embedding"
 
 class TestRAGSystem(unittest.TestCase):
     
@@ -29,6 +39,7 @@ class TestRAGSystem(unittest.TestCase):
     def test_document_loading(self):
         """Test that documents are loaded correctly"""
         rag = RAGSystem()
+        self.addCleanup(rag.close)
         docs = rag.load_documents()
         self.assertGreater(len(docs), 0, "No documents were loaded")
         
@@ -43,6 +54,7 @@ class TestRAGSystem(unittest.TestCase):
     def test_simple_query(self):
         """Test a simple query to ensure the RAG system works end-to-end"""
         rag = RAGSystem()
+        self.addCleanup(rag.close)
         
         # Test a basic query related to AI
         test_query = "What is artificial intelligence?"
@@ -58,10 +70,66 @@ class TestRAGSystem(unittest.TestCase):
             "Response doesn't seem relevant to the query"
         )
     
+    def test_query_with_context(self):
+        """Test that the answer and its retrieved contexts come back together"""
+        rag = RAGSystem()
+        self.addCleanup(rag.close)
+        
+        answer, contexts = rag.query_with_context("What is machine learning?")
+        
+        self.assertGreater(len(answer), 10, "Response was too short")
+        self.assertEqual(len(contexts), 3, "Expected the top 3 retrieved chunks")
+        self.assertTrue(all(isinstance(context, str) for context in contexts))
+    
+    def test_streamed_query(self):
+        """Test that a streamed answer arrives in chunks and is recorded in history"""
+        rag = RAGSystem()
+        
+        async def collect():
+            async with rag:
+                return [token async for token in rag.astream_query("What is an attention mechanism?")]
+        
+        tokens = asyncio.run(collect())
+        answer = "".join(tokens)
+        
+        self.assertGreater(len(answer), 10, "Response was too short")
+        self.assertEqual(rag.message_history.messages[-1].content, answer)
+    
+    def test_repeated_query_is_cached(self):
+        """Test that opening a new session with the same question returns the cached answer"""
+        test_query = "What is natural language processing?"
+        with RAGSystem() as rag:
+            first = rag.query(test_query)
+        
+        rag = RAGSystem()
+        self.addCleanup(rag.close)
+        with patch.object(rag, "rag_chain") as mock_chain:
+            second = rag.query(test_query)
+            mock_chain.invoke.assert_not_called()
+        
+        self.assertEqual(first, second, "Cached answer differs from the original")
+    
+    def test_concurrent_async_queries(self):
+        """Test that several questions can be answered concurrently"""
+        rag = RAGSystem()
+        questions = ["What is deep learning?", "What is a transformer model?"]
+        
+        async def ask_all():
+            async with rag:
+                return await asyncio.gather(*(rag.aquery(q) for q in questions))
+        
+        answers = asyncio.run(ask_all())
+        
+        self.assertEqual(len(answers), len(questions))
+        for answer in answers:
+            self.assertGreater(len(answer), 10, "Response was too short")
+        self.assertEqual(len(rag.message_history.messages), 2 * len(questions))
+    
     @patch('sys.stdout', new_callable=StringIO)
     def test_initialization_output(self, mock_stdout):
         """Test that the initialization provides appropriate output"""
         rag = RAGSystem()
+        self.addCleanup(rag.close)
         output = mock_stdout.getvalue()
         
         # Check initialization output
@@ -70,6 +138,205 @@ class TestRAGSystem(unittest.TestCase):
             "Initialization output doesn't mention documents being indexed"
         )
 
+class TestIndexing(unittest.TestCase):
+    """Indexing tests that run without an API key against a temporary directory"""
+    
+    def setUp(self):
+        """Run each test in an empty working directory with its own documents"""
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+        os.makedirs("documents")
+    
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+    
+    def make_rag(self):
+        """Create a RAG system with fake embeddings and a fake LLM, silencing its output"""
+        with patch('sys.stdout', new_callable=StringIO):
+            return RAGSystem(
+                embeddings=FakeEmbeddings(size=16),
+                llm=FakeListChatModel(responses=["Fake answer"])
+            )
+    
+    def write_document(self, name, text):
+        with open(os.path.join("documents", name), "w") as f:
+            f.write(text)
+    
+    def indexed_chunks(self):
+        """Map each indexed source file to its chunk texts"""
+        collection = chromadb.PersistentClient(path="./chroma_db").get_collection(COLLECTION_NAME)
+        result = collection.get(include=["documents", "metadatas"])
+        chunks = {}
+        for text, metadata in zip(result["documents"], result["metadatas"]):
+            chunks.setdefault(os.path.basename(metadata["source"]), []).append(text)
+        return chunks
+    
+    def test_new_documents_are_indexed(self):
+        """Test that every document is indexed on the first start and recorded in the manifest"""
+        self.write_document("a.txt", "Alpha document.")
+        self.write_document("b.txt", "Beta document.")
+        
+        rag = self.make_rag()
+        
+        self.assertIsNotNone(rag.rag_chain)
+        self.assertEqual(self.indexed_chunks(), {"a.txt": ["Alpha document."], "b.txt": ["Beta document."]})
+        self.assertEqual(
+            sorted(os.path.basename(path) for path in rag._load_manifest()),
+            ["a.txt", "b.txt"]
+        )
+    
+    def test_unchanged_documents_are_not_reloaded(self):
+        """Test that a warm start with an up-to-date manifest does not load or embed anything"""
+        self.write_document("a.txt", "Alpha document.")
+        self.make_rag()
+        
+        with patch.object(RAGSystem, "load_and_split") as mock_load:
+            rag = self.make_rag()
+            mock_load.assert_not_called()
+        self.assertIsNotNone(rag.rag_chain)
+        self.assertEqual(self.indexed_chunks(), {"a.txt": ["Alpha document."]})
+    
+    def test_modified_document_is_reindexed(self):
+        """Test that a modified document's chunks are replaced, reusing cached embeddings"""
+        paragraph = "Alpha paragraph. " * 40
+        self.write_document("a.txt", paragraph)
+        self.write_document("b.txt", "Beta document.")
+        self.make_rag()
+        
+        # Appending leaves the start of the file as it was, so the re-index mixes
+        # cached and freshly embedded chunks
+        self.write_document("a.txt", paragraph + "\n\n" + "Appended paragraph. " * 40)
+        self.make_rag()
+        
+        chunks = self.indexed_chunks()
+        self.assertGreater(len(chunks["a.txt"]), 1)
+        self.assertTrue(any("Appended paragraph." in chunk for chunk in chunks["a.txt"]))
+        self.assertEqual(chunks["b.txt"], ["Beta document."])
+    
+    def test_removed_document_is_dropped(self):
+        """Test that a deleted document's chunks and manifest entry are removed"""
+        self.write_document("a.txt", "Alpha document.")
+        self.write_document("b.txt", "Beta document.")
+        self.make_rag()
+        
+        os.remove(os.path.join("documents", "a.txt"))
+        rag = self.make_rag()
+        
+        self.assertEqual(self.indexed_chunks(), {"b.txt": ["Beta document."]})
+        self.assertEqual([os.path.basename(path) for path in rag._load_manifest()], ["b.txt"])
+    
+    def test_opening_question_is_embedded_once(self):
+        """Test that retrieval reuses the embedding computed for the answer cache lookup"""
+        self.write_document("a.txt", "Alpha document.")
+        rag = self.make_rag()
+        
+        with patch.object(FakeEmbeddings, "embed_query", autospec=True,
+                          side_effect=DeterministicFakeEmbedding.embed_query) as mock_embed:
+            answer, contexts = rag.query_with_context("What is alpha?")
+        
+        self.assertEqual(mock_embed.call_count, 1)
+        self.assertEqual(answer, "Fake answer")
+        self.assertEqual(contexts, ["Alpha document."])
+    
+    def test_http_clients_are_closed(self):
+        """Test that closing the system releases both OpenAI HTTP connection pools"""
+        self.write_document("a.txt", "Alpha document.")
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test-key"}), patch('sys.stdout', new_callable=StringIO):
+            rag = RAGSystem(embeddings=FakeEmbeddings(size=16))
+        
+        with rag:
+            pass
+        self.assertTrue(rag._http_client.is_closed)
+        self.assertFalse(rag._http_async_client.is_closed)
+        
+        asyncio.run(rag.aclose())
+        self.assertTrue(rag._http_async_client.is_closed)
+    
+    def test_follow_up_questions_bypass_answer_cache(self):
+        """Test that questions asked after earlier turns are neither looked up nor cached"""
+        self.write_document("a.txt", "Alpha document.")
+        rag = self.make_rag()
+        rag.message_history.add_user_message("What is alpha?")
+        rag.message_history.add_ai_message("Alpha is the first document.")
+        
+        with patch.object(rag, "_get_cached_answer") as mock_lookup, \
+                patch.object(rag, "_cache_answer") as mock_store:
+            answer = rag.query("Can you explain that in more detail?")
+            mock_lookup.assert_not_called()
+            mock_store.assert_not_called()
+        self.assertEqual(answer, "Fake answer")
+    
+    def test_mixed_cached_and_new_embeddings_are_upserted(self):
+        """Test that cached and freshly embedded vectors can be upserted together"""
+        rag = self.make_rag()
+        with patch('sys.stdout', new_callable=StringIO):
+            rag._embed_with_cache(["first chunk"])
+            vectors = rag._embed_with_cache(["first chunk", "second chunk"])
+        
+        collection = chromadb.PersistentClient(path="./chroma_db").get_or_create_collection("mixed")
+        collection.upsert(
+            ids=["first", "second"],
+            embeddings=vectors,
+            documents=["first chunk", "second chunk"]
+        )
+        self.assertEqual(collection.count(), 2)
+
+class TestRemoveDocuments(unittest.TestCase):
+    """Tests for the CLI's document removal, run in a temporary directory"""
+    
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+        os.makedirs("documents")
+        for name in ["Alpha.txt", "beta.txt", "beta2.txt"]:
+            open(os.path.join("documents", name), "w").close()
+    
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+    
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_remove_documents(self, mock_stdout):
+        """Test exact, case-insensitive, partial, ambiguous and missing names"""
+        remove_documents(["beta2.txt", "ALPHA", "beta", "gamma"])
+        
+        # beta2.txt matches exactly and ALPHA matches Alpha.txt regardless of case;
+        # after that "beta" is unambiguous, and "gamma" matches nothing
+        self.assertEqual(os.listdir("documents"), [])
+        output = mock_stdout.getvalue()
+        self.assertIn("Removed document: Alpha.txt", output)
+        self.assertIn("Error: Document gamma not found", output)
+        self.assertIn("Successfully removed 3 document(s)", output)
+    
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_ambiguous_partial_name_is_not_removed(self, mock_stdout):
+        """Test that a partial name matching several files removes nothing"""
+        remove_documents(["BETA"])
+        
+        self.assertEqual(sorted(os.listdir("documents")), ["Alpha.txt", "beta.txt", "beta2.txt"])
+        self.assertIn("Multiple files match 'BETA'", mock_stdout.getvalue())
+    
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_names_differing_only_in_case_are_ambiguous(self, mock_stdout):
+        """Test that a name matching several files case-insensitively removes nothing"""
+        open(os.path.join("documents", "Report.txt"), "w").close()
+        open(os.path.join("documents", "report.txt"), "w").close()
+        if len(os.listdir("documents")) < 5:
+            self.skipTest("File system is case-insensitive")
+        
+        remove_documents(["REPORT.TXT"])
+        self.assertIn("Report.txt", os.listdir("documents"))
+        self.assertIn("report.txt", os.listdir("documents"))
+        self.assertIn("Multiple files match 'REPORT.TXT'", mock_stdout.getvalue())
+        
+        # The exact name still removes just that file
+        remove_documents(["report.txt"])
+        self.assertIn("Report.txt", os.listdir("documents"))
+        self.assertNotIn("report.txt", os.listdir("documents"))
+
 def run_tests():
     unittest.main(argv=['first-arg-is-ignored'], exit=False)
 
@@ -8,6 +8,7 @@ from ragas.metrics import (
 from datasets import Dataset
 from main import RAGSystem
 import json
+import asyncio
 from typing import List, Dict
 
 def create_test_dataset() -> Dataset:
@@ -35,19 +36,21 @@ def create_test_dataset() -> Dataset:
     # Initialize RAG system
     rag = RAGSystem()
     
-    # Get contexts and answers from RAG system
-    for question in test_data["question"]:
-        # Get answer
-        answer = rag.query(question)
-        test_data["answer"].append(answer)
-        
-        # Get context used for this question
-        retrieved_docs = rag.vectorstore.similarity_search(question, k=3)
-        contexts = [doc.page_content for doc in retrieved_docs]
-        test_data["contexts"].append(contexts)
+    # Get contexts and answers from RAG system, running all questions concurrently
+    answers, contexts = asyncio.run(_collect_answers_and_contexts(rag, test_data["question"]))
+    test_data["answer"] = answers
+    test_data["contexts"] = contexts
     
     return Dataset.from_dict(test_data)
 
+async def _collect_answers_and_contexts(rag: RAGSystem, questions: List[str]):
+    """Query the RAG system for all questions concurrently, keeping the retrieved contexts"""
+    async with rag:
+        results = await asyncio.gather(*(rag.aquery_with_context(question) for question in questions))
+    answers = [answer for answer, _ in results]
+    contexts = [contexts for _, contexts in results]
+    return answers, contexts
+
 def evaluate_rag_system():
     """Evaluate RAG system using RAGAS metrics"""
     print("Starting RAG system evaluation...")